@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+__author__ = "romank@linux.microsoft.com"
+__version__ = "0.0.1"
+__license__ = "MIT"
+
+import os
+import sys
+import argparse
+import concurrent.futures
+import importlib.util
+import subprocess
+import logging
+from pathlib import Path
+
+log = logging.getLogger("build-all")
+log_format = "[%(asctime)s][%(levelname)-8s][%(name)-8s] %(message)s"
+
+script_dir = Path(__file__).resolve().parent
+
+# The disk image names follow the ones used in the Readme.
+image_names = {"x86_64": "x64", "arm64": "arm64"}
+
+def run_script(script, *script_args, sudo=False):
+    cmd = [sys.executable, str(script_dir / script), *script_args]
+    if sudo:
+        cmd = ["sudo", *cmd]
+    log.info("Running %s...", " ".join(cmd))
+    subprocess.run(cmd, check=True)
+
+def make_jobs():
+    # Reuse the heuristic from build-kernel.py, the file name is not importable as is.
+    spec = importlib.util.spec_from_file_location("build_kernel", script_dir / "build-kernel.py")
+    build_kernel = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(build_kernel)
+    return build_kernel.make_jobs()
+
+def build_arch(arch, config, jobs, args):
+    # The initial RAM disk gets embedded into the kernel, and the kernel goes
+    # onto the disk, so the steps for one arch run in order.
+    verbose = ["-v"] if args.verbose else []
+
+    run_script("build-initrd.py", *verbose, arch)
+
+    kernel_args = ["-c", config, "-l", args.linux, "-j", str(jobs)]
+    if args.wipe:
+        kernel_args.append("-w")
+    if args.redirect_stdout:
+        kernel_args.append("-r")
+    if args.modules:
+        kernel_args.append("-m")
+    run_script("build-kernel.py", *verbose, *kernel_args, arch)
+
+    if args.disk_image:
+        image, vhdx = f"{image_names[arch]}.img", f"{image_names[arch]}.vhdx"
+        # build-disk-image.py does not overwrite the images from the previous run.
+        for stale in (image, vhdx):
+            Path(stale).unlink(missing_ok=True)
+
+        os_loader = "bzImage" if arch == "x86_64" else "Image"
+        disk_args = ["--os-loader", f"{script_dir}/out/{config.replace('/', '-')}/{arch}/{os_loader}",
+                     "--target-image", vhdx]
+        if args.work_dir:
+            disk_args += ["--work-dir", args.work_dir]
+
+        # Only the disk image needs root, the rest of the build stays owned by the user.
+        # The credentials were cached upfront.
+        as_user = os.geteuid() != 0
+        run_script("build-disk-image.py", *verbose, *disk_args, image, arch, sudo=as_user)
+        if as_user:
+            subprocess.run(["sudo", "chown", f"{os.getuid()}:{os.getgid()}", image, vhdx], check=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the initial RAM disk, the kernel and optionally the disk image for each arch")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose logging", default=False)
+    parser.add_argument("-l", "--linux", type=str, help="Path to the Linux kernel source tree", default="./linux")
+    parser.add_argument("-w", "--wipe", action="store_true", help="Wipe out the build dirs before building", default=False)
+    parser.add_argument("-r", "--redirect-stdout", action="store_true", help="Redirect the standard output to the `build.log` file", default=False)
+    parser.add_argument("-m", "--modules", action="store_true", help="Build kernel modules", default=False)
+    parser.add_argument("--x86_64-config", type=str, help="Path to the x86_64 kernel configuration file, builds for x86_64 if given")
+    parser.add_argument("--arm64-config", type=str, help="Path to the arm64 kernel configuration file, builds for arm64 if given")
+    parser.add_argument("-d", "--disk-image", action="store_true", help="Build the `x64.img`/`arm64.img` and `x64.vhdx`/`arm64.vhdx` disk images, replacing the existing ones, runs `sudo` for that step", default=False)
+    parser.add_argument("--work-dir", help="Directory for the intermediate disk image files, e.g. a tmpfs such as /dev/shm (optional)")
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(level=log_level, format=log_format)
+
+    log.debug("Arguments: %s", args)
+
+    configs = {"x86_64": args.x86_64_config, "arm64": args.arm64_config}
+    configs = {arch: config for arch, config in configs.items() if config}
+    if not configs:
+        parser.error("at least one of --x86_64-config and --arm64-config is required")
+
+    # The kernel builds run at the same time, so they split one job budget
+    # rather than each sizing it for the whole memory.
+    jobs = max(1, make_jobs() // len(configs))
+    log.info("Using %d make jobs for each of %s", jobs, ", ".join(configs))
+
+    # Ask for the password once, now, rather than from the arch threads in
+    # the middle of the build output.
+    if args.disk_image and os.geteuid() != 0:
+        subprocess.run(["sudo", "-v"], check=True)
+
+    # The steps only wait on the child processes, threads are enough. The
+    # arches share nothing, so their builds overlap.
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(configs)) as executor:
+        futures = {executor.submit(build_arch, arch, config, jobs, args): arch for arch, config in configs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                log.info("Built %s", futures[future])
+            except Exception as e:
+                failed = True
+                if args.verbose:
+                    log.exception("Building %s failed: %s", futures[future], e)
+                else:
+                    log.error("Building %s failed: %s", futures[future], e)
+
+    if failed:
+        sys.exit(1)
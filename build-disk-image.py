@@ -4,11 +4,14 @@ __version__ = "0.0.5"
 __license__ = "MIT"
 
 import os
+import re
+import errno
+import sys
+import gzip
 from pathlib import Path
 import subprocess
 import shutil
 import tempfile
-import time
 import argparse
 import logging
 
@@ -29,173 +32,238 @@ EFI_UUID = "DEADBEEF"
 EXT4_UUID = "F59E7ACA-1868-4E4D-B34D-9087DDA43174"
 
 
-def create_partitions(loop_device, efi_start, efi_end_str):
+def create_partitions(raw_image, efi_size_mib, root_size_mib):
     """
-    Creates a GPT partition table on the loop device and creates two partitions:
-    - A FAT32 EFI system partition from efi_start to efi_end_str.
-    - An ext4 partition from efi_end_str to 100% of the disk.
+    Creates a GPT partition table in the raw disk image file and creates two partitions:
+    - A FAT32 EFI system partition from 1MiB spanning efi_size_mib.
+    - An ext4 partition right after it spanning root_size_mib.
 
-    Returns:
-        A tuple (part1, part2) representing the device paths for the EFI and ext4 partitions.
+    The image is partitioned as a regular file, no loop device is involved.
     """
-    log.info("Initializing %s with a GPT partition table...", loop_device)
-    subprocess.run(["parted", "-s", loop_device, "mklabel", "gpt"], check=True)
-
-    log.info("Creating EFI system partition from %s to %s...", efi_start, efi_end_str)
-    subprocess.run(
-        ["parted", "-s", loop_device, "mkpart", "primary", "fat32", efi_start, efi_end_str],
-        check=True
+    log.info("Creating GPT with EFI system partition of %sMiB and ext4 partition of %sMiB in '%s'...",
+             efi_size_mib, root_size_mib, raw_image)
+    # The whole table goes to sfdisk in one script, U is the EFI system
+    # partition type, L is the Linux file system one.
+    partition_table = (
+        "label: gpt\n"
+        f"start=1MiB, size={efi_size_mib}MiB, type=U\n"
+        f"size={root_size_mib}MiB, type=L\n"
     )
-    subprocess.run(["parted", "-s", loop_device, "set", "1", "boot", "on"], check=True)
-    subprocess.run(["parted", "-s", loop_device, "set", "1", "esp", "on"], check=True)
+    subprocess.run(["sfdisk", "--quiet", raw_image], input=partition_table, text=True, check=True)
 
-    log.info("Creating ext4 partition from %s to 100%% of the disk...", efi_end_str)
+
+def write_partition(raw_image, part_image, offset_mib):
+    """
+    Writes the file system image into the raw disk image at the partition offset.
+    The raw image is freshly allocated and reads back as zeros, so the zeroed
+    blocks of the file system image are skipped rather than written.
+    """
+    log.info("Writing '%s' into '%s' at %sMiB...", part_image, raw_image, offset_mib)
     subprocess.run(
-        ["parted", "-s", loop_device, "mkpart", "primary", "ext4", efi_end_str, "100%"],
+        ["dd", f"if={part_image}", f"of={raw_image}", "bs=1M", f"seek={offset_mib}", "conv=notrunc,sparse"],
         check=True
     )
 
-    time.sleep(2)
 
-    part1 = f"{loop_device}p1"
-    part2 = f"{loop_device}p2"
+def fill_boot_partition(part1, os_loader, arch):
+    """
+    Creates the EFI/Boot directory on the EFI (boot) partition, and copies
+    the OS loader file to the appropriate location based on the architecture.
+    The FAT file system is written directly with mtools, without mounting it.
+    """
+    if arch == "x86_64":
+        efi_file = "BOOTX64.EFI"
+    elif arch == "arm64":
+        efi_file = "BOOTAA64.EFI"
+    else:
+        raise ValueError(f"Unsupported architecture: {arch}")
 
-    if not os.path.exists(part1):
-        raise RuntimeError(f"Expected partition device {part1} does not exist.")
-    if not os.path.exists(part2):
-        raise RuntimeError(f"Expected partition device {part2} does not exist.")
+    # The partition size is rarely a multiple of the legacy geometry mtools checks for.
+    env = {**os.environ, "MTOOLS_SKIP_CHECK": "1"}
 
-    return part1, part2
+    log.info("Creating boot directory ::/EFI/Boot on %s...", part1)
+    subprocess.run(["mmd", "-i", part1, "::/EFI", "::/EFI/Boot"], env=env, check=True)
 
+    dest_loader = f"::/EFI/Boot/{efi_file}"
+    log.info("Copying OS loader from '%s' to '%s' on %s...", os_loader, dest_loader, part1)
+    subprocess.run(["mcopy", "-m", "-i", part1, os_loader, dest_loader], env=env, check=True)
 
-def fill_boot_partition(part1, os_loader, arch):
+
+def extract_layer(layer, dest_dir):
     """
-    Mounts the EFI (boot) partition, creates the EFI/Boot directory, and copies
-    the OS loader file to the appropriate location based on the architecture.
+    Decompresses the cpio.gz layer in-process and streams it into a single
+    `cpio` extracting into dest_dir. GNU cpio stops reading at the first
+    trailer, so each layer needs its own `cpio`, but no shell or `gunzip`.
     """
-    efi_mount_dir = tempfile.mkdtemp(prefix="efi_mount_")
-    log.info("Mounting boot partition %s to %s...", part1, efi_mount_dir)
-    subprocess.run(["mount", part1, efi_mount_dir], check=True)
+    proc = subprocess.Popen(["cpio", "-idm"], stdin=subprocess.PIPE, cwd=dest_dir)
     try:
-        boot_dir = os.path.join(efi_mount_dir, "EFI", "Boot")
-        log.info("Creating boot directory %s...", boot_dir)
-        os.makedirs(boot_dir, exist_ok=True)
-
-        if arch == "x86_64":
-            efi_file = "BOOTX64.EFI"
-        elif arch == "arm64":
-            efi_file = "BOOTAA64.EFI"
-        else:
-            raise ValueError(f"Unsupported architecture: {arch}")
-
-        dest_loader = os.path.join(boot_dir, efi_file)
-        log.info("Copying OS loader from '%s' to '%s'...", os_loader, dest_loader)
-        shutil.copy2(os_loader, dest_loader)
+        with gzip.open(layer, "rb") as gz:
+            shutil.copyfileobj(gz, proc.stdin, length=1 << 20)
+    except BrokenPipeError:
+        # cpio exited early, its exit status tells why.
+        pass
     finally:
-        log.info("Unmounting boot partition from %s...", efi_mount_dir)
-        subprocess.run(["umount", efi_mount_dir], check=True)
-        os.rmdir(efi_mount_dir)
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, proc.args)
 
 
-def fill_ext4_partition(part2, arch):
+def fill_ext4_partition(part2, size_mib, arch, temp_dir=None):
     """
-    Mounts the ext4 partition and extracts cpio.gz layers from the 'virtdisk-layers' directory.
+    Extracts cpio.gz layers from the 'virtdisk-layers' directory into a staging directory,
+    and creates the ext4 file system image of size_mib populating it from there with `mkfs.ext4 -d`.
     Only layers that are marked as "noarch" or match the specified architecture are processed.
     """
-    root_mount_dir = tempfile.mkdtemp(prefix="root_mount_")
-    log.info("Mounting ext4 partition %s to %s...", part2, root_mount_dir)
-    subprocess.run(["mount", part2, root_mount_dir], check=True)
+    staging_dir = tempfile.mkdtemp(prefix="root_staging_", dir=temp_dir)
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
         layers_dir = os.path.join(script_dir, "virtdisk-layers")
         if os.path.exists(layers_dir):
             found = False
+            # A layer is used if its name mentions either "noarch" or the arch.
+            layer_pattern = re.compile(rf"noarch|{re.escape(arch)}")
             for layer in sorted(Path(layers_dir).rglob("*.cpio.gz")):
                 log.debug(f"Found layer {layer}")
-                if "noarch" not in layer.name and arch not in layer.name:
+                if not layer_pattern.search(layer.name):
                     log.debug(f"Skipping {layer} (does not match arch {arch})")
                     continue
                 found = True
-                log.info("Extracting '%s' into ext4 partition at '%s'...", layer, root_mount_dir)
-                subprocess.run(f"gunzip -c {layer} | cpio -idm", shell=True, cwd=root_mount_dir, check=True)
+                log.info("Extracting '%s' into staging directory '%s'...", layer, staging_dir)
+                extract_layer(layer, staging_dir)
             if not found:
                 log.info("No appropriate cpio.gz files found in '%s'", layers_dir)
         else:
             log.warning("Directory '%s' does not exist, skipping layer extraction", layers_dir)
-    finally:
-        log.info("Unmounting ext4 partition from %s...", root_mount_dir)
-        subprocess.run(["umount", root_mount_dir], check=True)
-        os.rmdir(root_mount_dir)
-
 
-def new_efi_boot_disk(image_path, os_loader, arch, disk_size_mib=512, efi_size_mib=256,
-                        target_image=None, target_format=None):
-    if disk_size_mib <= efi_size_mib + 1:
-        raise ValueError("Disk size must be greater than EFI size plus 1 MiB for proper partition alignment.")
+        log.info("Formatting ext4 partition %s with fixed UUID %s from '%s'...", part2, EXT4_UUID, staging_dir)
+        subprocess.run(["mkfs.ext4", "-F", "-L", "ROOT", "-U", EXT4_UUID, "-d", staging_dir,
+                        part2, f"{size_mib}M"], check=True)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
-    if os.path.exists(image_path):
-        raise FileExistsError(f"Disk image at {image_path} already exists.")
 
+def build_raw_disk(raw_image, os_loader, arch, disk_size_mib, efi_size_mib, temp_dir):
     disk_size_str = f"{disk_size_mib}MiB"
-    efi_start = "1MiB"
-    efi_end_mib = 1 + efi_size_mib
-    efi_end_str = f"{efi_end_mib}MiB"
+    efi_offset_mib = 1
+    root_offset_mib = efi_offset_mib + efi_size_mib
+    # Leave the last MiB for the backup GPT.
+    root_size_mib = disk_size_mib - root_offset_mib - 1
 
-    log.info("Creating raw disk image '%s' of size %s...", image_path, disk_size_str)
+    log.info("Creating raw disk image '%s' of size %s...", raw_image, disk_size_str)
     try:
-        subprocess.run(["fallocate", "-l", disk_size_str, image_path], check=True)
+        subprocess.run(["fallocate", "-l", disk_size_str, raw_image], check=True)
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"Failed to create disk image: {e}")
 
-    log.info("Attaching disk image as a loop device with partition scanning...")
-    try:
-        result = subprocess.run(
-            ["losetup", "--find", "--partscan", "--show", image_path],
-            check=True,
-            stdout=subprocess.PIPE,
-            text=True,
-        )
-        loop_device = result.stdout.strip()
-        log.info("Loop device %s created.", loop_device)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to set up loop device: {e}")
+    create_partitions(raw_image, efi_size_mib, root_size_mib)
+
+    # The file systems are built in separate files and then written into the
+    # raw image, so no loop device, partition scanning or mounting is needed.
+    part1 = os.path.join(temp_dir, "efi.img")
+    part2 = os.path.join(temp_dir, "root.img")
 
+    log.info("Formatting boot partition %s as FAT32 with fixed UUID %s...", part1, EFI_UUID)
+    subprocess.run(
+        ["mkfs.fat", "-C", "-F32", "-n", "EFI", "-i", EFI_UUID, part1, str(efi_size_mib * 1024)],
+        check=True
+    )
+
+    # Fill the boot partition.
+    fill_boot_partition(part1, os_loader, arch)
+    write_partition(raw_image, part1, efi_offset_mib)
+    os.remove(part1)
+
+    # Fill the ext4 partition.
+    fill_ext4_partition(part2, root_size_mib, arch, temp_dir)
+    write_partition(raw_image, part2, root_offset_mib)
+    os.remove(part2)
+
+
+def move_sparse(src, dst):
+    """
+    Moves the raw image, copying it across file systems with holes for the
+    zeroed blocks so that only the data gets written to the destination.
+    """
     try:
-        # Create partitions on the loop device.
-        part1, part2 = create_partitions(loop_device, efi_start, efi_end_str)
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    subprocess.run(["cp", "--sparse=always", src, dst], check=True)
+    os.remove(src)
+
 
-        log.info("Formatting boot partition %s as FAT32 with fixed UUID %s...", part1, EFI_UUID)
-        subprocess.run(["mkfs.fat", "-F32", "-n", "EFI", "-i", EFI_UUID, part1], check=True)
+def new_efi_boot_disk(image_path, os_loader, arch, disk_size_mib=512, efi_size_mib=256,
+                        target_images=(), target_formats=(), work_dir=None):
+    if disk_size_mib <= efi_size_mib + 2:
+        raise ValueError("Disk size must be greater than EFI size plus 2 MiB for proper partition alignment and the GPT.")
 
-        log.info("Formatting ext4 partition %s...", part2)
-        subprocess.run(["mkfs.ext4", "-F", "-L", "ROOT", part2], check=True)
-        log.info("Setting fixed UUID on ext4 partition %s to %s...", part2, EXT4_UUID)
-        subprocess.run(["tune2fs", "-U", EXT4_UUID, part2], check=True)
+    if len(target_images) != len(target_formats):
+        raise ValueError("Each target image needs a target format.")
 
-        # Fill the boot partition.
-        fill_boot_partition(part1, os_loader, arch)
+    if os.path.exists(image_path):
+        raise FileExistsError(f"Disk image at {image_path} already exists.")
 
-        # Fill the ext4 partition.
-        fill_ext4_partition(part2, arch)
+    # With a work dir (e.g. on a tmpfs), the raw image and the intermediate
+    # files live there, and only the finished images get written to the destination.
+    # Otherwise, the intermediate files go next to the image, not to /tmp.
+    if work_dir:
+        os.makedirs(work_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix="hyperv-build-",
+                                dir=work_dir or os.path.dirname(os.path.abspath(image_path)))
+    raw_image = os.path.join(temp_dir, os.path.basename(image_path)) if work_dir else image_path
+    log.info("Using work directory '%s'...", temp_dir)
+
+    raw_image_built = False
+    try:
+        build_raw_disk(raw_image, os_loader, arch, disk_size_mib, efi_size_mib, temp_dir)
+        raw_image_built = True
 
+        # The conversions run side by side, so the raw image is read from
+        # the disk once and then served from the page cache to the rest.
+        conversions = []
+        try:
+            for target_image, target_format in zip(target_images, target_formats):
+                log.info("Converting raw image '%s' to format '%s' as '%s'...",
+                         raw_image, target_format, target_image)
+                # Run 16 coroutines to keep more I/O in flight. Out-of-order writes
+                # would fragment the images that allocate blocks as they are written.
+                out_of_order = ["-W"] if target_format == "raw" else []
+                conversions.append((target_image, subprocess.Popen(
+                    ["qemu-img", "convert", "-m", "16", *out_of_order, "-O", target_format, raw_image, target_image]
+                )))
+            failed = []
+            for target_image, proc in conversions:
+                if proc.wait() != 0:
+                    failed.append(target_image)
+                else:
+                    log.info("Image conversion complete. Converted image is available at '%s'.", target_image)
+        except BaseException:
+            # Do not leave the conversions running while the raw image is cleaned up.
+            for _, proc in conversions:
+                if proc.poll() is None:
+                    proc.terminate()
+            for _, proc in conversions:
+                proc.wait()
+            raise
+        if failed:
+            raise RuntimeError(f"Image conversion failed for {failed}")
     finally:
-        log.info("Detaching loop device %s...", loop_device)
-        subprocess.run(["losetup", "-d", loop_device], check=True)
+        try:
+            # Keep the raw image even if a conversion fails.
+            if raw_image_built and raw_image != image_path:
+                log.info("Moving raw image '%s' to '%s'...", raw_image, image_path)
+                move_sparse(raw_image, image_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
     log.info("EFI boot disk image created successfully at '%s'.", image_path)
 
-    if target_image and target_format:
-        log.info("Converting raw image '%s' to format '%s' as '%s'...",
-                 image_path, target_format, target_image)
-        try:
-            subprocess.run(
-                ["qemu-img", "convert", "-O", target_format, image_path, target_image],
-                check=True
-            )
-            log.info("Image conversion complete. Converted image is available at '%s'.", target_image)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Image conversion failed: {e}")
-
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -210,13 +278,20 @@ if __name__ == '__main__':
                         help="Total disk image size in MiB (default: 512)")
     parser.add_argument("--efi-size", type=int, default=256,
                         help="EFI partition size in MiB (default: 256)")
-    parser.add_argument("--target-image", help="Path for the converted disk image file (optional)")
-    parser.add_argument("--target-format",
+    parser.add_argument("--target-image", action="append", default=[],
+                        help="Path for the converted disk image file (optional, can be repeated)")
+    parser.add_argument("--target-format", action="append", default=[],
                         choices=["raw", "qcow2", "vmdk", "vdi", "vhdx", "vpc"],
-                        default="vhdx",
-                        help="Target disk format for conversion (allowed choices: raw, qcow2, vmdk, vdi, vhdx, vpc)")
+                        help="Target disk format for conversion, one per target image in the same order, "
+                             "vhdx if omitted (allowed choices: raw, qcow2, vmdk, vdi, vhdx, vpc)")
+    parser.add_argument("--work-dir",
+                        help="Directory for the intermediate files, e.g. a tmpfs such as /dev/shm (optional)")
     args = parser.parse_args()
 
+    if len(args.target_format) > len(args.target_image):
+        parser.error("more target formats than target images")
+    args.target_format += ["vhdx"] * (len(args.target_image) - len(args.target_format))
+
     log_level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(level=log_level, format=log_format)
 
@@ -255,11 +330,13 @@ if __name__ == '__main__':
             args.arch,
             disk_size_mib=args.disk_size,
             efi_size_mib=args.efi_size,
-            target_image=args.target_image,
-            target_format=args.target_format
+            target_images=args.target_image,
+            target_formats=args.target_format,
+            work_dir=args.work_dir
         )
     except Exception as e:
         if args.verbose:
             log.exception("An error occurred: %s", e)
         else:
             log.error("An error occurred: %s", e)
+        sys.exit(1)
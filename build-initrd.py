@@ -3,20 +3,61 @@ __author__ = "romank@linux.microsoft.com"
 __version__ = "0.0.1"
 __license__ = "MIT"
 
+import os
+import re
+import sys
 import argparse
 import logging
 from pathlib import Path
-import shutil
 
 log = logging.getLogger("build-initrd")
 log_format = "[%(asctime)s][%(levelname)-8s][%(name)-8s] %(message)s"
 
+def copy_layer(inf, outf):
+    # Let the kernel copy the data, no bytes pass through the userspace buffers.
+    # copy_file_range() can even share the extents where the file system supports
+    # that, sendfile() is the fallback, and plain reads and writes are the last resort.
+    # A method that stops short hands over to the next one at the reached offset.
+    size = os.fstat(inf.fileno()).st_size
+    offset = 0
+    try:
+        while offset < size:
+            copied = os.copy_file_range(inf.fileno(), outf.fileno(), size - offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+    except OSError as e:
+        log.debug(f"copy_file_range() failed: {e}")
+    if offset == size:
+        return
+    try:
+        while offset < size:
+            sent = os.sendfile(outf.fileno(), inf.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except OSError as e:
+        log.debug(f"sendfile() failed: {e}")
+    if offset == size:
+        return
+    inf.seek(offset)
+    while chunk := inf.read(1 << 20):
+        outf.write(chunk)
+        offset += len(chunk)
+    # The next layer may be copied through the file descriptor again.
+    outf.flush()
+    # The output is preallocated, a short copy would go unnoticed as zeros.
+    if offset != size:
+        raise RuntimeError(f"Copied only {offset} of {size} bytes of {inf.name}")
+
 def build_initrd(layers_dir, out_file, arch):
     layers_list = []
     log.info(f"Searching for layers in {layers_dir}")
+    # A layer is used if its name mentions either "noarch" or the arch.
+    layer_pattern = re.compile(rf"noarch|{re.escape(arch)}")
     for layer in sorted(Path(layers_dir).rglob("*.cpio.gz")):
         log.debug(f"Found layer {layer}")
-        if "noarch" not in layer.name and arch not in layer.name:
+        if not layer_pattern.search(layer.name):
             continue
         layers_list.append(layer)
     log.debug(f"Found layers {layers_list}")
@@ -24,10 +65,17 @@ def build_initrd(layers_dir, out_file, arch):
     if layers_list:
         log.info(f"Concatenating layers {layers_list} into {out_file}")
         with open(out_file, "wb") as outf:
+            # Allocate the whole file at once to get contiguous extents.
+            total_size = sum(layer.stat().st_size for layer in layers_list)
+            if total_size:
+                try:
+                    os.posix_fallocate(outf.fileno(), 0, total_size)
+                except OSError as e:
+                    log.debug(f"posix_fallocate() failed: {e}")
             for layer in layers_list:
                 log.info(f"Adding {layer}")
                 with open(layer, "rb") as inf:
-                    shutil.copyfileobj(inf, outf)
+                    copy_layer(inf, outf)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Builds initramfs")
@@ -49,3 +97,4 @@ if __name__ == "__main__":
             log.exception("An error occurred: %s", e)
         else:
             log.error("An error occurred: %s", e)
+        sys.exit(1)
@@ -4,10 +4,12 @@ __version__ = "0.0.1"
 __license__ = "MIT"
 
 import os
+import errno
 import sys
 import platform
 
 import argparse
+import concurrent.futures
 import subprocess
 import shutil
 import logging
@@ -16,10 +18,55 @@ from pathlib import Path
 log = logging.getLogger("build-kernel")
 log_format = "[%(asctime)s][%(levelname)-8s][%(name)-8s] %(message)s"
 
-PARALLELISM_MULTIPLIER = 4
+def mem_available_gib():
+    with open("/proc/meminfo") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // (1024 * 1024)
+    return None
+
+def make_jobs():
+    # Each compiler process can take a few hundred MiB, so allow a job per
+    # GiB of available memory, and not more than two per CPU.
+    cpus = os.cpu_count()
+    jobs = cpus * 2
+    mem_gib = mem_available_gib()
+    if mem_gib is not None:
+        jobs = min(jobs, max(1, mem_gib))
+    log.info("Using %d make jobs for %d CPUs and %s GiB of available memory", jobs, cpus, mem_gib)
+    return jobs
+
+def link_or_copy(src, dst):
+    # A hard link moves no data when the build and out dirs share a file system.
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def strip_module(objcopy, eu_strip, mod, outmod, outdbg):
+    if eu_strip:
+        # One process splits the debug info and adds the debug link. Only the
+        # debug sections are removed, the module loader needs the symbols.
+        subprocess.run([eu_strip, "-g", "-f", outdbg, "-o", outmod, mod], check=True)
+        return
+    subprocess.run([objcopy, "--only-keep-debug", "--compress-debug-sections", mod, outdbg], check=True)
+    subprocess.run([objcopy, "--strip-unneeded", "--add-gnu-debuglink", outdbg, mod, outmod], check=True)
+
+def walk_dbg(root):
+    # The entry types come from readdir, no stat() per file unlike rglob().
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".dbg") and entry.is_file(follow_symlinks=False):
+                    yield entry.path
 
 class KernelBuilder:
-    def __init__(self, arch, linux_src, build_dir, out_dir, config_file, redirect_stdout, build_modules):
+    def __init__(self, arch, linux_src, build_dir, out_dir, config_file, redirect_stdout, build_modules, jobs=None, use_eu_strip=False):
         self.arch = arch
         self.linux_src = linux_src
         self.build_dir = build_dir
@@ -27,6 +74,8 @@ class KernelBuilder:
         self.config_file = config_file
         self.redirect_stdout = redirect_stdout
         self.build_modules = build_modules
+        self.jobs = jobs
+        self.use_eu_strip = use_eu_strip
 
     def build_kernel(self):
         if "Linux" not in platform.platform():
@@ -36,7 +85,8 @@ class KernelBuilder:
         if self.build_modules:
             targets.extend(["modules", "modules_install"])
 
-        makeargs = ["-j", str(PARALLELISM_MULTIPLIER*os.cpu_count()),
+        # The load average limit throttles the build if something else is running.
+        makeargs = ["-j", str(self.jobs or make_jobs()), f"--load-average={os.cpu_count()}",
                     f"ARCH={self.arch}",
                     f"INSTALL_MOD_PATH={self.out_dir}/modules",
                     f"INSTALL_HDR_PATH={self.out_dir}/headers"
@@ -56,52 +106,97 @@ class KernelBuilder:
         else:
             raise Exception("unsupported arch")
 
-        for target in targets:
-            log.info(f"Building target {target}...")
-            stdout = None if not self.redirect_stdout else subprocess.PIPE
-            result = subprocess.run(["make", *makeargs, target],
-                           stdout=stdout, check=True, cwd=self.linux_src)
-            log.info("Build result: %s", result.returncode)
-
-            if self.redirect_stdout:
-                with open(f"{self.build_dir}/build-{target}.log", "wb") as file:
-                    file.write(result.stdout)
+        # The kernel images in the out dir are hard links into the build dir,
+        # and kbuild rewrites those in place. Drop the links so that a rebuild,
+        # and especially a failed one, leaves no half-written image in the out dir.
+        for image in ("bzImage", "Image"):
+            if os.path.lexists(f"{self.out_dir}/{image}"):
+                os.remove(f"{self.out_dir}/{image}")
+
+        # A single invocation lets kbuild order the targets and keep the
+        # job pool busy instead of draining it between the targets.
+        log.info(f"Building targets {' '.join(targets)}...")
+        if self.redirect_stdout:
+            # make writes to the log file directly, the output is neither held
+            # in memory nor delayed until the build finishes.
+            with open(f"{self.build_dir}/build.log", "wb") as file:
+                result = subprocess.run(["make", *makeargs, *targets],
+                               stdout=file, check=True, cwd=self.linux_src)
+        else:
+            result = subprocess.run(["make", *makeargs, *targets],
+                           check=True, cwd=self.linux_src)
+        log.info("Build result: %s", result.returncode)
 
         if "vmlinux" in targets:
             log.info("Stripping and compressing kernel debug info...")
 
-            shutil.copy(f"{self.build_dir}/vmlinux", self.out_dir)
-
-            vmlinux_path = f"{self.out_dir}/vmlinux"
+            # objcopy reads vmlinux from the build dir and writes the out dir
+            # files itself, no need to copy it over first.
+            vmlinux_path = f"{self.build_dir}/vmlinux"
             vmlinux_dbg = f"{self.out_dir}/vmlinux.dbg"
             subprocess.run([objcopy, "--only-keep-debug", "--compress-debug-sections", vmlinux_path, vmlinux_dbg], check=True)
             subprocess.run([objcopy, "--strip-all", "--add-gnu-debuglink=" + vmlinux_dbg, vmlinux_path, f"{self.out_dir}/vmlinux"], check=True)
 
         if self.arch == "arm64" and "Image" in targets:
-            shutil.copy(f"{self.build_dir}/arch/{self.arch}/boot/Image", self.out_dir)
+            link_or_copy(f"{self.build_dir}/arch/{self.arch}/boot/Image", f"{self.out_dir}/Image")
         if self.arch == "x86_64" and "bzImage" in targets:
-            shutil.copy(f"{self.build_dir}/arch/{self.arch}/boot/bzImage", self.out_dir)
+            link_or_copy(f"{self.build_dir}/arch/{self.arch}/boot/bzImage", f"{self.out_dir}/bzImage")
 
         if "modules" in targets:
             log.info("Copying modules to the out dir...")
 
-            for mod in Path(self.build_dir).rglob("*.ko"):
-                relative_path = str(mod).replace(str(self.build_dir), "")
-                dest_dir = f"{self.out_dir}/{os.path.dirname(relative_path)}"
-                os.makedirs(dest_dir, exist_ok=True)
-                outmod = f"{dest_dir}/{os.path.basename(mod)}"
-                subprocess.run([objcopy, "--only-keep-debug", "--compress-debug-sections", str(mod), f"{outmod}.dbg"], check=True)
-                subprocess.run([objcopy, "--strip-unneeded", "--add-gnu-debuglink", f"{outmod}.dbg", str(mod), outmod], check=True)
+            modules = []
+            build_dir = str(self.build_dir)
+            prefix_len = len(build_dir)
+            created_dirs = set()
+            for root, _, files in os.walk(build_dir):
+                dest_dir = f"{self.out_dir}{root[prefix_len:]}"
+                for name in files:
+                    if not name.endswith(".ko"):
+                        continue
+                    if dest_dir not in created_dirs:
+                        os.makedirs(dest_dir, exist_ok=True)
+                        created_dirs.add(dest_dir)
+                    outmod = f"{dest_dir}/{name}"
+                    modules.append((f"{root}/{name}", outmod, f"{outmod}.dbg"))
+
+            # eu-strip from elfutils handles ELF files for any arch. Its output differs
+            # from the objcopy one, so it is only used when asked for.
+            eu_strip = None
+            if self.use_eu_strip:
+                eu_strip = shutil.which("eu-strip")
+                if not eu_strip:
+                    raise Exception("eu-strip was requested but is not installed")
+            log.debug("Splitting the module debug info with %s", eu_strip or objcopy)
+
+            # The workers only wait on the child processes, threads are enough to keep all CPUs busy.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = [executor.submit(strip_module, objcopy, eu_strip, *module) for module in modules]
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        # Do not wait for the queued modules on the first failure.
+                        executor.shutdown(cancel_futures=True)
+                        raise
 
         log.info("Moving the debug info into a separate directory...")
 
-        for dbg in Path(self.out_dir).rglob("*.dbg"):
-            relative_path = str(dbg).replace(str(self.out_dir), "")
-            dest_dir = f"{self.out_dir}/DWARF/{os.path.dirname(relative_path)}"
-            os.makedirs(dest_dir, exist_ok=True)
-            basename = os.path.basename(dbg).replace(".dbg", ".dwarf")
-            outdbg = f"{dest_dir}/{basename}"
-            shutil.move(dbg, outdbg)
+        out_dir = str(self.out_dir)
+        created_dirs = set()
+        for dbg in walk_dbg(out_dir):
+            relative_dir, basename = os.path.split(dbg[len(out_dir):])
+            dest_dir = f"{out_dir}/DWARF{relative_dir}"
+            if dest_dir not in created_dirs:
+                os.makedirs(dest_dir, exist_ok=True)
+                created_dirs.add(dest_dir)
+            outdbg = f"{dest_dir}/{basename[:-len('.dbg')]}.dwarf"
+            try:
+                os.rename(dbg, outdbg)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(dbg, outdbg)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Builds the kernel")
@@ -109,9 +204,11 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--linux", type=str, help="Path to the Linux kernel source tree", default="./linux")
     parser.add_argument("-i", "--initrd", type=str, help="Initial RAM disk")
     parser.add_argument("-w", "--wipe", action="store_true", help="Do not clean before building, the default is not to wipe out the build dir", default=False)
-    parser.add_argument("-r", "--redirect-stdout", action="store_true", help="Redirect the standard output to the `build*.log` files", default=False)
+    parser.add_argument("-r", "--redirect-stdout", action="store_true", help="Redirect the standard output to the `build.log` file", default=False)
     parser.add_argument("-c", "--config", type=str, help="Path to the Linux kernel configuration file", required=True)
     parser.add_argument("-m", "--modules", action="store_true", help="Build kernel modules", default=False)
+    parser.add_argument("-j", "--jobs", type=int, help="Number of make jobs, the default depends on the CPUs and the available memory")
+    parser.add_argument("--eu-strip", action="store_true", help="Split the module debug info with eu-strip in one pass, keeps the local symbols and does not compress the debug info", default=False)
     parser.add_argument("arch", choices=["x86_64", "arm64"], help="Build arch")
     args = parser.parse_args()
 
@@ -141,12 +238,12 @@ if __name__ == "__main__":
             shutil.rmtree(build_dir, ignore_errors=True)
             shutil.rmtree(out_dir, ignore_errors=True)
 
-        if not build_dir.exists():
-            build_dir.mkdir(parents=True)
+        build_dir.mkdir(parents=True, exist_ok=True)
         build_dir = build_dir.resolve()
 
-        if not out_dir.exists():
-            out_dir.mkdir(parents=True)
+        # The subdirs bring the out dir along.
+        (out_dir / "modules").mkdir(parents=True, exist_ok=True)
+        (out_dir / "headers").mkdir(parents=True, exist_ok=True)
         out_dir = out_dir.resolve()
 
         log.info("Copying the initial RAM disk")
@@ -155,21 +252,17 @@ if __name__ == "__main__":
         else:
             shutil.copy(f"{script_dir}/initrd-{args.arch}.cpio.gz", f"{build_dir}/initrd-{args.arch}.cpio.gz")
 
-        os.makedirs(build_dir, exist_ok=True)
-        os.makedirs(out_dir, exist_ok=True)
-        os.makedirs(f"{out_dir}/modules", exist_ok=True)
-        os.makedirs(f"{out_dir}/headers", exist_ok=True)
-
         os.chdir(linux_src)
 
         os.environ["KBUILD_OUTPUT"] = str(build_dir)
         os.environ["KCONFIG_CONFIG"] = str(config_file)
 
         log.info(f"Building {args.arch} kernel, config {config_file}...")
-        builder = KernelBuilder(args.arch, linux_src, build_dir, out_dir, args.config, args.redirect_stdout, args.modules)
+        builder = KernelBuilder(args.arch, linux_src, build_dir, out_dir, args.config, args.redirect_stdout, args.modules, args.jobs, args.eu_strip)
         builder.build_kernel()
     except Exception as e:
         if args.verbose:
             log.exception("An error occurred: %s", e)
         else:
             log.error("An error occurred: %s", e)
+        sys.exit(1)